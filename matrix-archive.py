@@ -2,7 +2,7 @@
 
 """matrix-archive
 
-Archive Matrix room messages. Creates a YAML log of all room
+Archive Matrix room messages. Creates a JSON Lines log of all room
 messages, including media.
 
 Use the unattended batch mode to fetch everything in one go without
@@ -42,6 +42,7 @@ Example calls:
 
 
 from nio import (
+    Api,
     AsyncClient,
     AsyncClientConfig,
     MatrixRoom,
@@ -55,22 +56,48 @@ from nio import (
     store,
     exceptions
 )
+from binascii import Error as BinAsciiError
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from functools import partial
-from typing import Union, TextIO
+from typing import AsyncIterator, Iterable, Optional, Union, TextIO
 from urllib.parse import urlparse
 import aiofiles
+import aiohttp
 import argparse
 import asyncio
 import getpass
+import hashlib
 import itertools
+import orjson
 import os
 import re
+import shutil
 import sys
+import unpaddedbase64
 import yaml
-import json
 
 
 DEVICE_NAME = "matrix-archive"
+MAX_CONCURRENT_DOWNLOADS = 16
+MAX_CONCURRENT_ROOMS = 3
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Media may take any time to download but mustn't stall. nio passes a
+# timeout with every request, which overrides any session default.
+MEDIA_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_read=60)
+# Media is written once this much data or this many chunks are pending,
+# which keeps well below the IOV_MAX limit of writev
+MEDIA_WRITE_SIZE = 1 << 20
+MAX_WRITE_CHUNKS = 256
+# Records which event each file in a media directory belongs to
+MEDIA_MANIFEST = ".manifest.jsonl"
+# Appended to the name of media files until they're fully downloaded
+PARTIAL_SUFFIX = ".part"
+# Tasks saving each distinct media, which return the file it was saved to
+MEDIA_DOWNLOADS = {}
+# Next numbered suffix to try in choose_filename for each filename
+FILENAME_COUNTERS = {}
+# Names in use in each directory choose_filename has picked names in
+DIRECTORY_FILENAMES = {}
 
 
 def parse_args():
@@ -166,6 +193,37 @@ def parse_args():
     return parser.parse_args()
 
 
+class BufferedLogWriter:
+    """Write to a file in large blocks, fsyncing it on close"""
+
+    FLUSH_SIZE = 1 << 20
+
+    def __init__(self, path: str):
+        self.file = open(path, "wb")
+        self.buffer = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, data: bytes) -> None:
+        self.buffer += data
+        if len(self.buffer) >= self.FLUSH_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        self.file.write(self.buffer)
+        self.buffer.clear()
+
+    def close(self) -> None:
+        self.flush()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+
 def mkdir(path):
     try:
         os.mkdir(path)
@@ -187,6 +245,19 @@ async def create_client() -> AsyncClient:
         user=user_id,
         config=AsyncClientConfig(store=store.SqliteMemoryStore),
     )
+    # Keep enough connections alive to the homeserver for concurrent
+    # media downloads to reuse them instead of handshaking every time:
+    # one per download plus one for API requests of every room being
+    # archived at the same time.
+    max_connections = MAX_CONCURRENT_ROOMS * (MAX_CONCURRENT_DOWNLOADS + 1)
+    client.client_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=max_connections,
+            limit_per_host=max_connections,
+            ttl_dns_cache=300,
+            keepalive_timeout=75,
+        ),
+    )
     await client.login(password, DEVICE_NAME)
     client.load_store()
     room_keys_path = ARGS.keys
@@ -207,13 +278,57 @@ async def select_room(client: AsyncClient) -> MatrixRoom:
     return client.rooms[room_id]
 
 
+def write_file(path: str, data: bytes) -> None:
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def link_file(source: str, filename: str) -> None:
+    """Hard link filename to source, or copy it if linking fails"""
+    try:
+        os.link(source, filename)
+    except OSError:
+        # Keep the timestamps of source, like a link does
+        shutil.copy2(source, filename)
+
+
+def reserved_names(name: str) -> tuple:
+    """Return the names a media file takes up, as compared by choose_filename"""
+    return name.casefold(), (name + PARTIAL_SUFFIX).casefold()
+
+
+def taken_filenames(directory: str) -> set:
+    """Return the names in use in directory, as compared by choose_filename"""
+    taken = DIRECTORY_FILENAMES.get(directory)
+    if taken is None:
+        # Scan the directory once and track the names handed out since.
+        # Names are case-folded to be safe on filesystems such as APFS
+        # and NTFS.
+        try:
+            taken = {
+                taken_name
+                for entry in os.scandir(directory or ".")
+                for taken_name in reserved_names(entry.name)
+            }
+        except OSError:  # Such as a missing directory
+            taken = set()
+        DIRECTORY_FILENAMES[directory] = taken
+    return taken
+
+
 def choose_filename(filename):
-    start, ext = os.path.splitext(filename)
-    for i in itertools.count(1):
-        if not os.path.exists(filename):
+    directory, name = os.path.split(filename)
+    taken = taken_filenames(directory)
+    start, ext = os.path.splitext(name)
+    # Carry on numbering from the last name handed out for this file,
+    # so repeated collisions only need to check the next candidate
+    for i in itertools.count(FILENAME_COUNTERS.get(filename, 0)):
+        name = f"{start}({i}){ext}" if i else f"{start}{ext}"
+        if taken.isdisjoint(reserved_names(name)):
             break
-        filename = f"{start}({i}){ext}"
-    return filename
+    taken.update(reserved_names(name))
+    FILENAME_COUNTERS[filename] = i + 1
+    return os.path.join(directory, name)
 
 
 async def write_event(
@@ -264,10 +379,32 @@ async def write_event(
 
 async def save_avatars(client: AsyncClient, room: MatrixRoom) -> None:
     avatar_dir = mkdir(f"{OUTPUT_DIR}/{room.display_name}_{room.room_id}_avatars")
-    for user in room.users.values():
-        if user.avatar_url:
-            async with aiofiles.open(f"{avatar_dir}/{user.user_id}", "wb") as f:
-                await f.write(await download_mxc(client, user.avatar_url))
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+
+    async def save_avatar(user):
+        async with semaphore:
+            avatar = await download_mxc(client, user.avatar_url)
+        await asyncio.to_thread(write_file, f"{avatar_dir}/{user.user_id}", avatar)
+
+    results = await asyncio.gather(
+        *(save_avatar(user) for user in room.users.values() if user.avatar_url),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            print(result, file=sys.stderr)
+
+
+def attachment_decryptor(key: str, iv: str):
+    """Create an OpenSSL AES-CTR decryptor for an encrypted attachment"""
+    try:
+        cipher = Cipher(
+            algorithms.AES(unpaddedbase64.decode_base64(key)),
+            modes.CTR(unpaddedbase64.decode_base64(iv)),
+        )
+    except (BinAsciiError, TypeError, ValueError) as e:
+        raise exceptions.EncryptionError(e)
+    return cipher.decryptor()
 
 
 async def download_mxc(client: AsyncClient, url: str):
@@ -279,11 +416,324 @@ async def download_mxc(client: AsyncClient, url: str):
         return b''
 
 
+def write_chunks(fd: int, chunks: list) -> None:
+    """Write out and empty a list of chunks with as few syscalls as possible"""
+    while chunks:
+        written = os.writev(fd, chunks)
+        # Drop the chunks that were written and the start of a partially
+        # written one
+        while chunks and written >= len(chunks[0]):
+            written -= len(chunks.pop(0))
+        if written:
+            chunks[0] = memoryview(chunks[0])[written:]
+
+
+def write_media_chunks(
+    fd: int, chunks: list, hasher, decryptor, buffer: Optional[bytearray]
+) -> None:
+    """Write out downloaded chunks of media, decrypting them if necessary"""
+    if decryptor is not None:
+        # Decrypt into the buffer reused for every batch
+        view = memoryview(buffer)
+        size = 0
+        for chunk in chunks:
+            hasher.update(chunk)
+            size += decryptor.update_into(chunk, view[size:])
+        chunks = [view[:size]]
+    write_chunks(fd, chunks)
+
+
+def replay_media(filename: str, hasher, decryptor) -> None:
+    """Run the plaintext saved so far back through hasher and decryptor"""
+    # AES-CTR encrypts and decrypts alike, so this recovers the ciphertext
+    # and advances the counter to where the download stopped
+    with open(filename, "rb") as f:
+        while block := f.read(MEDIA_WRITE_SIZE):
+            hasher.update(decryptor.update(block))
+
+
+async def get_retry_after(response: aiohttp.ClientResponse) -> float:
+    """Read how many seconds to wait before retrying a rate limited request"""
+    async with response:
+        try:
+            retry_after_ms = (await response.json(content_type=None))["retry_after_ms"]
+        except (aiohttp.ClientError, KeyError, TypeError, ValueError):
+            retry_after_ms = None
+    if isinstance(retry_after_ms, int):
+        return retry_after_ms / 1000
+    retry_after = response.headers.get("Retry-After", "")
+    # Same default as nio
+    return int(retry_after) if retry_after.isdigit() else 5
+
+
+async def send_media_request(
+    client: AsyncClient, method: str, path: str, headers: Optional[dict]
+) -> aiohttp.ClientResponse:
+    """Send a media request, retrying it like nio's AsyncClient._send"""
+    got_429 = got_timeouts = 0
+    while True:
+        try:
+            response = await client.send(
+                method, path, headers=headers, timeout=MEDIA_TIMEOUT
+            )
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            got_timeouts += 1
+            max_timeouts = client.config.max_timeouts
+            if max_timeouts is not None and got_timeouts > max_timeouts:
+                raise
+            await asyncio.sleep(await client.get_timeout_retry_wait_time(got_timeouts))
+            continue
+        if response.status != 429:
+            return response
+        got_429 += 1
+        max_429 = client.config.max_limit_exceeded
+        if max_429 is not None and got_429 > max_429:
+            return response
+        await asyncio.sleep(await get_retry_after(response))
+
+
+def content_range_start(response: aiohttp.ClientResponse) -> Optional[int]:
+    match = re.match(r"bytes (\d+)-", response.headers.get("Content-Range", ""))
+    return int(match[1]) if match else None
+
+
+async def download_mxc_to_file(
+    client: AsyncClient,
+    url: str,
+    filename: str,
+    file_info: Optional[dict],
+    timestamp: int,
+) -> None:
+    """Stream media to a file, decrypting it on the way if necessary"""
+    hasher = decryptor = buffer = writing = None
+    if file_info is not None:
+        # Check the file info before downloading anything
+        try:
+            key, iv = file_info["key"]["k"], file_info["iv"]
+            expected_hash = unpaddedbase64.decode_base64(file_info["hashes"]["sha256"])
+        except (BinAsciiError, KeyError, TypeError) as e:
+            raise exceptions.EncryptionError(e)
+        decryptor = attachment_decryptor(key, iv)
+        hasher = hashlib.sha256()
+        # Fits the largest batch, plus the block of slack that older
+        # versions of cryptography require for update_into
+        buffer = bytearray(MEDIA_WRITE_SIZE + DOWNLOAD_CHUNK_SIZE + 16)
+    # Media is renamed into place once complete, and an interrupted
+    # download is resumed from the partial file with a range request
+    partial = filename + PARTIAL_SUFFIX
+    try:
+        offset = os.path.getsize(partial)
+    except FileNotFoundError:
+        offset = 0
+    mxc = urlparse(url)
+    # Bypass client.download, which reads the whole body into memory
+    method, path = Api.download(mxc.netloc, mxc.path.strip("/"))
+    headers = {"Range": f"bytes={offset}-"} if offset else None
+    response = await send_media_request(client, method, path, headers)
+    if response.status == 206 and content_range_start(response) != offset:
+        # Start over rather than append a range that doesn't follow on
+        response.release()
+        offset = 0
+        response = await send_media_request(client, method, path, None)
+    # The partial file can already hold all of the media if a previous
+    # attempt stopped just before renaming it
+    complete = response.status == 416 and offset > 0
+    if response.status not in (200, 206) and not complete:
+        response.release()
+        raise aiohttp.ClientResponseError(
+            response.request_info,
+            response.history,
+            status=response.status,
+            message=response.reason,
+            headers=response.headers,
+        )
+    # Servers that ignore the range send everything again with a 200
+    resume = offset > 0 and response.status != 200
+    fd = os.open(
+        partial,
+        os.O_WRONLY | os.O_CREAT | (os.O_APPEND if resume else os.O_TRUNC),
+        0o666,
+    )
+
+    async def flush(chunks):
+        nonlocal writing
+        # Hash, decrypt and write in a thread to keep the event loop free,
+        # while the next batch downloads. Shielded so that a cancelled
+        # download only closes the file once the thread is done with it.
+        if writing is not None:
+            await asyncio.shield(writing)
+        writing = asyncio.ensure_future(asyncio.to_thread(
+            write_media_chunks, fd, chunks, hasher, decryptor, buffer
+        ))
+
+    try:
+        try:
+            async with response:
+                if resume and file_info is not None:
+                    await asyncio.to_thread(replay_media, partial, hasher, decryptor)
+                if not complete:
+                    # Gather chunks to write them out with a single writev
+                    chunks, size = [], 0
+                    async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        chunks.append(chunk)
+                        size += len(chunk)
+                        if size >= MEDIA_WRITE_SIZE or len(chunks) >= MAX_WRITE_CHUNKS:
+                            await flush(chunks)
+                            chunks, size = [], 0
+                    await flush(chunks)
+                    await asyncio.shield(writing)
+            # Set atime and mtime of file to event timestamp, through the
+            # open file where the platform allows it
+            os.utime(
+                fd if os.utime in os.supports_fd else partial,
+                ns=((timestamp * 1000000,) * 2),
+            )
+        finally:
+            if writing is None or writing.done():
+                os.close(fd)
+            else:
+                writing.add_done_callback(lambda _: os.close(fd))
+        if file_info is not None:
+            if hasher.digest() != expected_hash:
+                raise exceptions.EncryptionError("Mismatched SHA-256 digest.")
+    except exceptions.EncryptionError:
+        # Don't leave corrupt media behind to resume from
+        os.remove(partial)
+        raise
+    os.replace(partial, filename)
+
+
+def read_media_manifest(media_dir: str) -> dict:
+    """Map event IDs to the files previous runs saved their media to"""
+    manifest = {}
+    try:
+        with open(f"{media_dir}/{MEDIA_MANIFEST}", "rb") as f:
+            for line in f:
+                try:
+                    entry = orjson.loads(line)
+                except orjson.JSONDecodeError:  # Line cut short by a crash
+                    continue
+                manifest[entry["event_id"]] = f"{media_dir}/{entry['filename']}"
+    except FileNotFoundError:
+        pass
+    return manifest
+
+
+def media_name(event: RoomMessage) -> str:
+    # Keep media inside the media directory whatever its body says
+    name = os.path.basename(event.body)
+    if name in ("", ".", ".."):
+        name = os.path.basename(urlparse(event.url).path)
+    return name
+
+
+def is_media_saved(event: RoomMessage, filename: str) -> bool:
+    try:
+        size = os.path.getsize(filename)
+    except OSError:
+        return False
+    info = event.source["content"].get("info")
+    if isinstance(info, dict) and isinstance(info.get("size"), int):
+        return size == info["size"]
+    # Media is only renamed into place once it's complete, but failed
+    # downloads used to leave empty files behind
+    return size > 0
+
+
+async def iterate_async(items: Iterable) -> AsyncIterator:
+    for item in items:
+        yield item
+
+
+async def download_media(
+    client: AsyncClient, events: AsyncIterator, media_dir: Optional[str]
+):
+    """Yield events in order with the tasks downloading their media, if any"""
+    if media_dir is None:
+        async for event in events:
+            yield event, None
+        return
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+    # Bounds how far downloads run ahead of the consumer
+    queue = asyncio.Queue(4 * MAX_CONCURRENT_DOWNLOADS)
+    saved_media = read_media_manifest(media_dir)
+    # Keep the names of media that has to be downloaded again for it
+    taken = taken_filenames(media_dir)
+    for filename in saved_media.values():
+        taken.update(reserved_names(os.path.basename(filename)))
+    manifest = open(f"{media_dir}/{MEDIA_MANIFEST}", "ab", buffering=0)
+
+    async def fetch(event, filename, file_info, original):
+        # Record the filename up front, so that an interrupted download
+        # can be resumed into the same file by a later run
+        manifest.write(orjson.dumps(dict(
+            event_id=event.event_id, filename=os.path.basename(filename),
+        )) + b"\n")
+        if original is None:
+            async with semaphore:
+                await download_mxc_to_file(
+                    client, event.url, filename, file_info, event.server_timestamp
+                )
+        else:
+            # Reuse the file of the first event with this media
+            await asyncio.to_thread(link_file, await original, filename)
+        return filename
+
+    async def produce():
+        try:
+            async for event in events:
+                download = None
+                if isinstance(event, (RoomMessageMedia, RoomEncryptedMedia)):
+                    # Unencrypted media has no file info
+                    file_info = event.source["content"].get("file")
+                    # Reposted media has the same URL and, if encrypted, the
+                    # same key to decrypt it with
+                    media_key = event.url if file_info is None else orjson.dumps(
+                        file_info, option=orjson.OPT_SORT_KEYS
+                    )
+                    original = MEDIA_DOWNLOADS.get(media_key)
+                    if original is not None and original.done() and (
+                        original.cancelled() or original.exception() is not None
+                    ):
+                        original = None  # Try again if saving it failed before
+                    filename = saved_media.get(event.event_id)
+                    if filename is not None and is_media_saved(event, filename):
+                        download = asyncio.get_running_loop().create_future()
+                        download.set_result(filename)
+                    else:
+                        # Media that wasn't completely saved before is
+                        # downloaded into the same file again
+                        if filename is None:
+                            # Choose filenames up front so that colliding
+                            # names are numbered in event order
+                            filename = choose_filename(f"{media_dir}/{media_name(event)}")
+                        download = asyncio.ensure_future(
+                            fetch(event, filename, file_info, original)
+                        )
+                    if original is None:
+                        MEDIA_DOWNLOADS[media_key] = download
+                await queue.put((event, download))
+        finally:
+            # Wake the consumer even if producing failed
+            await queue.put(None)
+
+    producer = asyncio.ensure_future(produce())
+    try:
+        while (item := await queue.get()) is not None:
+            yield item
+        # Raise whatever stopped the producer early
+        await producer
+    finally:
+        manifest.close()
+        producer.cancel()
+        while not queue.empty():
+            item = queue.get_nowait()
+            if item is not None and item[1] is not None:
+                item[1].cancel()
+
+
 def is_valid_event(event):
-    events = (RoomMessageFormatted, RedactedEvent)
-    if not ARGS.no_media:
-        events += (RoomMessageMedia, RoomEncryptedMedia)
-    return isinstance(event, events)
+    return isinstance(event, VALID_EVENT_TYPES)
 
 
 async def fetch_room_events(
@@ -291,17 +741,23 @@ async def fetch_room_events(
     start_token: str,
     room: MatrixRoom,
     direction: MessageDirection,
-) -> list:
-    events = []
-    while True:
-        response = await client.room_messages(
-            room.room_id, start_token, limit=1000, direction=direction
-        )
-        if len(response.chunk) == 0:
-            break
-        events.extend(event for event in response.chunk if is_valid_event(event))
-        start_token = response.end
-    return events
+):
+    """Yield the valid events of a room, prefetching the next page"""
+    fetch_page = partial(
+        client.room_messages, room.room_id, limit=1000, direction=direction
+    )
+    next_page = asyncio.ensure_future(fetch_page(start_token))
+    try:
+        while True:
+            response = await next_page
+            if len(response.chunk) == 0:
+                break
+            next_page = asyncio.ensure_future(fetch_page(response.end))
+            for event in response.chunk:
+                if is_valid_event(event):
+                    yield event
+    finally:
+        next_page.cancel()
 
 
 async def write_room_events(client, room):
@@ -314,73 +770,84 @@ async def write_room_events(client, room):
     # sometimes depending on the sync, front events need to be fetched
     # as well.
     fetch_room_events_ = partial(fetch_room_events, client, start_token, room)
-    async with aiofiles.open(
-        f"{OUTPUT_DIR}/{room.display_name}_{room.room_id}.json", "w"
+    media_dir = None
+    if not ARGS.no_media:
+        media_dir = mkdir(f"{OUTPUT_DIR}/{room.display_name}_{room.room_id}_media")
+    with BufferedLogWriter(
+        f"{OUTPUT_DIR}/{room.display_name}_{room.room_id}.jsonl"
     ) as f_json:
+        # Back events arrive newest first, so they're all fetched before
+        # being written out oldest first. Front events are streamed.
+        back_events = [event async for event in fetch_room_events_(MessageDirection.back)]
         for events in [
-            reversed(await fetch_room_events_(MessageDirection.back)),
-            await fetch_room_events_(MessageDirection.front),
+            iterate_async(reversed(back_events)),
+            fetch_room_events_(MessageDirection.front),
         ]:
-            events_parsed = []
-            for event in events:
-                try:
-                    if not ARGS.no_media:
-                        media_dir = mkdir(f"{OUTPUT_DIR}/{room.display_name}_{room.room_id}_media")
-
-                    # add additional information to the message source
-                    sender_name = f"<{event.sender}>"
-                    if event.sender in room.users:
-                        # If user is still present in room, include current nickname
-                        sender_name = f"{room.users[event.sender].display_name} {sender_name}"
-                        event.source["_sender_name"] = sender_name
-
-                    # download media if necessary
-                    if isinstance(event, (RoomMessageMedia, RoomEncryptedMedia)):
-                        media_data = await download_mxc(client, event.url)
-                        filename = choose_filename(f"{media_dir}/{event.body}")
-                        event.source["_file_path"] = filename
-                        async with aiofiles.open(filename, "wb") as f_media:
-                            try:
-                                await f_media.write(
-                                    crypto.attachments.decrypt_attachment(
-                                        media_data,
-                                        event.source["content"]["file"]["key"]["k"],
-                                        event.source["content"]["file"]["hashes"]["sha256"],
-                                        event.source["content"]["file"]["iv"],
-                                    )
-                                )
-                            except KeyError:  # EAFP: Unencrypted media produces KeyError
-                                await f_media.write(media_data)
-                            # Set atime and mtime of file to event timestamp
-                            os.utime(filename, ns=((event.server_timestamp * 1000000,) * 2))
-
-                    # write out the processed message source
-                    events_parsed.append(event.source)
-                except exceptions.EncryptionError as e:
-                    print(e, file=sys.stderr)
-            # serialise message array
-            await f_json.write(json.dumps(events_parsed, indent=4))
+            async for event, download in download_media(client, events, media_dir):
+                # add additional information to the message source
+                sender_name = f"<{event.sender}>"
+                if event.sender in room.users:
+                    # If user is still present in room, include current nickname
+                    sender_name = f"{room.users[event.sender].display_name} {sender_name}"
+                    event.source["_sender_name"] = sender_name
+
+                # wait for the media download if necessary
+                if download is not None:
+                    try:
+                        event.source["_file_path"] = await download
+                    except (
+                        exceptions.EncryptionError,
+                        aiohttp.ClientError,
+                        asyncio.TimeoutError,
+                        OSError,
+                    ) as e:
+                        # Skip events whose media couldn't be saved rather
+                        # than abandoning the rest of the room
+                        print(f"{event.event_id}: {e!r}", file=sys.stderr)
+                        continue
+
+                # write out the processed message source
+                f_json.write(orjson.dumps(event.source, option=orjson.OPT_APPEND_NEWLINE))
     await save_avatars(client, room)
-    print("Successfully wrote all room events to disk.")
+    print(f"Successfully wrote all {room.room_id} room events to disk.")
 
 
 async def main() -> None:
+    room_ids = set(ARGS.room)
+    room_patterns = [re.compile(pattern) for pattern in ARGS.roomregex]
     try:
         client = await create_client()
         await client.sync(
             full_state=True,
             # Limit fetch of room events as they will be fetched later
             sync_filter={"room": {"timeline": {"limit": 1}}})
-        for room_id, room in client.rooms.items():
-            # Iterate over rooms to see if a room has been selected to
-            # be automatically fetched
-            if room_id in ARGS.room or any(re.match(pattern, room_id) for pattern in ARGS.roomregex):
-                print(f"Selected room: {room_id}")
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_ROOMS)
+
+        async def write_selected_room(room):
+            async with semaphore:
+                print(f"Selected room: {room.room_id}")
                 await write_room_events(client, room)
+
+        selected_rooms = [
+            room
+            for room_id, room in client.rooms.items()
+            # Check if a room has been selected to be automatically fetched
+            if room_id in room_ids or any(pattern.match(room_id) for pattern in room_patterns)
+        ]
+        # Let the other rooms finish before the client is closed if one fails
+        results = await asyncio.gather(
+            *(write_selected_room(room) for room in selected_rooms),
+            return_exceptions=True,
+        )
+        failed = False
+        for room, result in zip(selected_rooms, results):
+            if isinstance(result, Exception):
+                failed = True
+                print(f"Failed to write {room.room_id} room events: {result!r}", file=sys.stderr)
         if ARGS.batch:
             # If the program is running in unattended batch mode,
             # then we can quit at this point
-            raise SystemExit
+            raise SystemExit(1 if failed else 0)
         else:
             while True:
                 room = await select_room(client)
@@ -398,4 +865,13 @@ if __name__ == "__main__":
         # Select all rooms by adding a regex pattern which matches every string
         ARGS.roomregex.append(".*")
     OUTPUT_DIR = mkdir(ARGS.folder)
+    VALID_EVENT_TYPES = (RoomMessageFormatted, RedactedEvent)
+    if not ARGS.no_media:
+        VALID_EVENT_TYPES += (RoomMessageMedia, RoomEncryptedMedia)
+    try:
+        # Use the faster libuv based event loop if it's available
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
     asyncio.get_event_loop().run_until_complete(main())